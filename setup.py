@@ -19,7 +19,8 @@ setup(
     install_requires=[
         'requests~=2.21',
         'peewee==3.9.3',
-        'cachetools==3.1.0'
+        'cachetools==3.1.0',
+        'orjson~=3.0'
     ],
     tests_require=[
         'pytest==4.3.1',
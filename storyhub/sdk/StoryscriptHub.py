@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
-import json
 import os
 import sys
-from threading import Lock
+from functools import lru_cache
+from hashlib import blake2b
+from threading import Event, Lock
 from typing import Union
-from unittest.mock import MagicMock
+from uuid import UUID
 
-from cachetools import TTLCache, cached
+from cachetools import LRUCache, TTLCache
+from cachetools.keys import hashkey
 
-from peewee import DoesNotExist
+import orjson
+
+from peewee import DoesNotExist, chunked
 
 from storyhub.sdk.AutoUpdateThread import AutoUpdateThread
 from storyhub.sdk.GraphQL import GraphQL
@@ -18,16 +22,44 @@ from storyhub.sdk.db.Service import Service
 from storyhub.sdk.service.ServiceData import ServiceData
 
 
+def _signature(raw_data: bytes) -> int:
+    """
+    A fast 64-bit content signature, used to detect services which changed.
+    """
+    return int.from_bytes(blake2b(raw_data, digest_size=8).digest(), 'big')
+
+
+def _service_cache_key(alias=None, owner=None, name=None,
+                       wrap_service=False):
+    """
+    Builds the cache key of a StoryscriptHub.get lookup, so single entries
+    can be evicted.
+    """
+    return hashkey(alias, owner, name, wrap_service)
+
+
+_NAMES_KEY = hashkey()
+_MISS = object()
+
+# database directories created by this process already
+_made_dirs = set()
+
+
 class StoryscriptHub:
     update_thread = None
 
-    retry_lock = Lock()
-    update_lock = Lock()
-
-    ttl_cache_for_services = TTLCache(maxsize=128, ttl=1 * 60)
-    ttl_cache_for_service_names = TTLCache(maxsize=1, ttl=1 * 60)
+    # keeps every statement below SQLite's 999 bind variable limit
+    UPSERT_BATCH_SIZE = 50
+    DELETE_BATCH_SIZE = 500
+    LOOKUP_BATCH_SIZE = 300
+    UPSERT_PRESERVE_FIELDS = [
+        Service.name, Service.alias, Service.username, Service.description,
+        Service.certified, Service.public, Service._topics_raw, Service.state,
+        Service._configuration_raw, Service.readme, Service.raw_data
+    ]
 
     @staticmethod
+    @lru_cache(maxsize=16)
     def get_config_dir(app):
         if sys.platform == 'win32':
             p = os.getenv('APPDATA')
@@ -50,9 +82,36 @@ class StoryscriptHub:
         if db_path is None:
             db_path = StoryscriptHub.get_config_dir('.storyscript')
 
-        os.makedirs(db_path, exist_ok=True)
+        if db_path not in _made_dirs:
+            os.makedirs(db_path, exist_ok=True)
+            _made_dirs.add(db_path)
 
         self.db_path = db_path
+        # peewee keeps one connection per thread, any other thread (like
+        # the auto update thread) connects on its first query
+        self._db = Database(db_path).connect()
+        # uuid -> (signature, (alias, owner, name)) of the services this hub
+        # saw on its last update
+        self._last_seen = {}
+
+        # caches are per hub, so hubs don't serve or evict each other's
+        # entries. Nothing expires, update_cache and invalidate evict
+        # whatever changed.
+        self._svc_cache = LRUCache(maxsize=1024)
+        self._names_cache = LRUCache(maxsize=1)
+        # lookups which found nothing only expire, so services published
+        # later are fetched from the hub again
+        self._miss_cache = TTLCache(maxsize=1024, ttl=1 * 60)
+
+        # locks are per hub, so hubs don't wait on each other's updates
+        self.retry_lock = Lock()
+        self.update_lock = Lock()
+        # bumped on every invalidation, see _store
+        self._cache_generation = 0
+
+        self._updating = False
+        self._update_done = Event()
+        self._update_done.set()
 
         self._service_wrapper = None
         if service_wrapper:
@@ -65,7 +124,6 @@ class StoryscriptHub:
             self.update_thread = AutoUpdateThread(
                 update_function=self.update_cache)
 
-    @cached(cache=ttl_cache_for_service_names)
     def get_all_service_names(self) -> [str]:
         """
         Get all service names and aliases from the database.
@@ -73,18 +131,30 @@ class StoryscriptHub:
         :return: An array of strings, which might look like:
         ["hello", "universe/hello"]
         """
+        services = self._names_cache.get(_NAMES_KEY)
+        if services is None:
+            generation = self._cache_generation
+            services = self._get_all_service_names()
+            self._store(self._names_cache, {_NAMES_KEY: services}, generation)
+
+        return services
+
+    def _get_all_service_names(self) -> [str]:
+        # the names are concatenated by SQLite, and rows are read as plain
+        # tuples rather than Service instances
+        query = Service.select(
+            Service.alias,
+            Service.username.concat('/').concat(Service.name)).tuples()
+
         services = []
-        with Database(self.db_path):
-            for s in Service.select(Service.name, Service.alias,
-                                    Service.username):
-                if s.alias:
-                    services.append(s.alias)
+        for alias, full_name in query:
+            if alias:
+                services.append(alias)
 
-                services.append(f'{s.username}/{s.name}')
+            services.append(full_name)
 
         return services
 
-    @cached(cache=ttl_cache_for_services)
     def get(self, alias=None, owner=None, name=None,
             wrap_service=False) -> Union[Service, ServiceData]:
         """
@@ -97,93 +167,353 @@ class StoryscriptHub:
         @ServiceData object
         :return: Returns a Service instance, with all fields populated
         """
+        # "owner/name" aliases are resolved first, so a service is cached
+        # under one key regardless of how it was asked for
+        alias, owner, name = self._lookup(alias, owner, name)
+        key = _service_cache_key(alias, owner, name, wrap_service)
+        service = self._svc_cache.get(key, _MISS)
+        if service is _MISS and key not in self._miss_cache:
+            generation = self._cache_generation
+            service = self._find(alias, owner, name, wrap_service)
+            if service is None:
+                # Maybe it's new in the Hub?
+                self._update_or_wait()
+                generation = self._cache_generation
+                service = self._find(alias, owner, name, wrap_service)
+
+            if service is None:
+                self._store(self._miss_cache, {key: True}, generation)
+            else:
+                self._store(self._svc_cache, {key: service}, generation)
+
+        if service is _MISS:
+            return None
 
-        service = None
+        return service
 
+    def _find(self, alias: str, owner: str, name: str,
+              wrap_service: bool) -> Union[Service, ServiceData]:
         # check if the service_wrapper was initialized for automatic
-        # wrapping
+        # wrapping, it hands out ServiceData objects already
         if self._service_wrapper is not None:
             service = self._service_wrapper.get(alias=alias, owner=owner,
                                                 name=name)
+            if service is not None:
+                return service
 
-        if service is None:
-            service = self._get(alias, owner, name)
-
-        if service is None:
-            # Maybe it's new in the Hub?
-            with self.retry_lock:
-                service = self._get(alias, owner, name)
-                if service is None:
-                    self.update_cache()
-                    service = self._get(alias, owner, name)
+        service = self._get(alias, owner, name)
 
         if service is not None:
-            # ensures test don't break
-            if isinstance(service, MagicMock):
-                return service
-
-            assert isinstance(service, Service) or \
-                isinstance(service, ServiceData)
+            assert isinstance(service, Service)
             # if the service wrapper is set, and the service doesn't exist
             # we can safely convert this object since it was probably loaded
             # from the cache
             if wrap_service or self._service_wrapper is not None:
                 return ServiceData.from_dict(data={
-                    "service_data": json.loads(service.raw_data)
+                    "service_data": orjson.loads(service.raw_data)
                 })
 
-            if service.topics is not None:
-                service.topics = json.loads(service.topics)
+        return service
 
-            if service.configuration is not None:
-                service.configuration = json.loads(service.configuration)
+    def get_many(self, keys: [tuple],
+                 wrap_service=False) -> [Union[Service, ServiceData]]:
+        """
+        Get several services from the database, with a single query for all
+        the services which aren't cached yet.
+
+        :param keys: (alias, owner, name) tuples, as they would be passed
+        to get
+        :param wrap_service: When set to true, it will return @ServiceData
+        objects
+        :return: The services in the order of keys, None for services
+        which don't exist
+        """
+        keys = [self._lookup(*key) for key in keys]
+        results = [None] * len(keys)
+        missing = {}
+        for i, (alias, owner, name) in enumerate(keys):
+            key = _service_cache_key(alias, owner, name, wrap_service)
+            service = self._svc_cache.get(key, _MISS)
+            if service is not _MISS:
+                results[i] = service
+            elif key not in self._miss_cache:
+                missing[i] = key
+
+        if missing:
+            generation = self._cache_generation
+            lookups = {keys[i] for i in missing}
+            found = self._find_many(lookups, wrap_service)
+            if len(found) < len(lookups):
+                # Maybe they're new in the Hub? A single update covers all
+                # of them, everything is read again as the update might
+                # have changed the services found already
+                self._update_or_wait()
+                generation = self._cache_generation
+                found = self._find_many(lookups, wrap_service)
+
+            services = {}
+            misses = {}
+            for i, key in missing.items():
+                results[i] = found.get(keys[i])
+                if results[i] is None:
+                    misses[key] = True
+                else:
+                    services[key] = results[i]
 
-        return service
+            self._store(self._svc_cache, services, generation)
+            self._store(self._miss_cache, misses, generation)
+
+        return results
+
+    def _find_many(self, lookups: set, wrap_service: bool) -> dict:
+        """
+        Resolves lookups the way _find does, with a single query for the
+        ones the service wrapper doesn't know.
+        """
+        found = {}
+        if self._service_wrapper is not None:
+            for lookup in lookups:
+                service = self._service_wrapper.get(*lookup)
+                if service is not None:
+                    found[lookup] = service
+
+        remaining = lookups - set(found)
+        if remaining:
+            for lookup, service in self._get_many(remaining).items():
+                if wrap_service or self._service_wrapper is not None:
+                    service = ServiceData.from_dict(data={
+                        "service_data": orjson.loads(service.raw_data)
+                    })
+
+                found[lookup] = service
+
+        return found
+
+    @staticmethod
+    def _lookup(alias: str = None, owner: str = None, name: str = None):
+        """
+        Resolves the arguments of get into the column values to look a
+        service up with, as an (alias, owner, name) tuple.
+        """
+        if alias is not None and alias.count("/") == 1:
+            owner, name = alias.split("/")
+            alias = None
+
+        if alias:
+            return alias, None, None
+
+        return None, owner, name
+
+    def _get_many(self, lookups: [tuple]) -> dict:
+        lookups = set(lookups)
+
+        found = {}
+        for batch in chunked(lookups, self.LOOKUP_BATCH_SIZE):
+            aliases = [alias for alias, _, _ in batch if alias]
+            owners = [owner for alias, owner, _ in batch if not alias]
+            names = [name for alias, _, name in batch if not alias]
+
+            query = Service.select().where(
+                Service.alias.in_(aliases) |
+                (Service.username.in_(owners) & Service.name.in_(names)))
+
+            # owners and names are matched independently by the query, so
+            # only the requested pairs are kept
+            for service in query:
+                for lookup in ((service.alias, None, None),
+                               (None, service.username, service.name)):
+                    if any(lookup) and lookup in lookups:
+                        found[lookup] = service
+
+        return found
 
     def _get(self, alias: str = None, owner: str = None, name: str = None):
+        alias, owner, name = self._lookup(alias, owner, name)
         try:
-            if alias is not None and alias.count("/") == 1:
-                owner, name = alias.split("/")
-                alias = None
-
-            with Database(self.db_path):
-                if alias:
-                    service = Service.select().where(Service.alias == alias)
-                else:
-                    service = Service.select().where(
-                        (Service.username == owner) & (Service.name == name))
+            if alias:
+                service = Service.select().where(Service.alias == alias)
+            else:
+                service = Service.select().where(
+                    (Service.username == owner) & (Service.name == name))
 
-                return service.get()
+            return service.get()
         except DoesNotExist:
             return None
 
+    def _update_or_wait(self):
+        """
+        Updates the cache, unless another thread is updating it already,
+        in which case this waits for that update to finish instead.
+        """
+        with self.retry_lock:
+            waiting = self._updating
+            if not waiting:
+                self._updating = True
+                self._update_done.clear()
+
+        if waiting:
+            self._update_done.wait()
+            return
+
+        try:
+            self.update_cache()
+        finally:
+            with self.retry_lock:
+                self._updating = False
+                self._update_done.set()
+
     def update_cache(self):
         services = GraphQL.get_all()
 
+        # a few values repeat across every service, these share one string
+        # for as long as the service wrapper holds on to the services
+        for service in services:
+            service['state'] = sys.intern(service['state'])
+            owner = service['service']['owner']
+            owner['username'] = sys.intern(owner['username'])
+
         # tell the service wrapper to reload any services from the cache.
         if self._service_wrapper is not None:
             self._service_wrapper.reload_services(services)
 
-        with Database(self.db_path) as db:
-            with db.atomic(lock_type='IMMEDIATE'):
-                Service.delete().execute()
-                for service in services:
-                    Service.create(
-                        service_uuid=service['serviceUuid'],
-                        name=service['service']['name'],
-                        alias=service['service']['alias'],
-                        username=service['service']['owner']['username'],
-                        description=service['service']['description'],
-                        certified=service['service']['isCertified'],
-                        public=service['service']['public'],
-                        topics=json.dumps(service['service']['topics']),
-                        state=service['state'],
-                        configuration=json.dumps(service['configuration']),
-                        readme=service['readme'],
-                        raw_data=json.dumps(service))
+        # all serialization and hashing happens up front. While the write
+        # lock below is held, stored rows are only compared as strings.
+        rows = []
+        sigs = {}
+        for service in services:
+            uuid = UUID(service['serviceUuid'])
+            raw_data = orjson.dumps(service)
+            sigs[uuid] = _signature(raw_data)
+            rows.append({
+                'service_uuid': uuid,
+                'name': service['service']['name'],
+                'alias': service['service']['alias'],
+                'username': service['service']['owner']['username'],
+                'description': service['service']['description'],
+                'certified': service['service']['isCertified'],
+                'public': service['service']['public'],
+                '_topics_raw': orjson.dumps(
+                    service['service']['topics']).decode(),
+                'state': service['state'],
+                '_configuration_raw': orjson.dumps(
+                    service['configuration']).decode(),
+                'readme': service['readme'],
+                'raw_data': raw_data.decode()
+            })
+
+        with self._db.atomic(lock_type='IMMEDIATE'):
+            # the rows are diffed against what is stored right now, the
+            # database is shared with other hubs and processes
+            existing = {}
+            stored = {}
+            for s in Service.select(Service.service_uuid, Service.alias,
+                                    Service.username, Service.name,
+                                    Service.raw_data):
+                existing[s.service_uuid] = (s.alias, s.username, s.name)
+                stored[s.service_uuid] = s.raw_data
+
+            # only rows which are new or whose data differs are written
+            changed = [row for row in rows
+                       if stored.get(row['service_uuid']) != row['raw_data']]
+
+            removed = set(existing) - {row['service_uuid'] for row in rows}
+            for batch in chunked(removed, self.DELETE_BATCH_SIZE):
+                Service.delete().where(
+                    Service.service_uuid.in_(batch)).execute()
+
+            for batch in chunked(changed, self.UPSERT_BATCH_SIZE):
+                Service.insert_many(batch).on_conflict(
+                    conflict_target=[Service.service_uuid],
+                    preserve=self.UPSERT_PRESERVE_FIELDS).execute()
+
+        # evictions are based on what this hub saw on its previous update,
+        # not on the database, which other hubs may have written already
+        previous = self._last_seen
+        self._last_seen = {
+            row['service_uuid']: (sigs[row['service_uuid']],
+                                  (row['alias'], row['username'], row['name']))
+            for row in rows
+        }
+
+        # both the previous and the new names of a service are evicted, in
+        # case it has been renamed or got a new alias
+        stale = []
+        for uuid, (sig, names) in self._last_seen.items():
+            seen = previous.get(uuid)
+            if seen is None:
+                stale.append(names)
+            elif seen[0] != sig:
+                stale.append(names)
+                stale.append(seen[1])
+
+        for uuid in previous.keys() - self._last_seen.keys():
+            stale.append(previous[uuid][1])
+
+        names_changed = \
+            {names for _, names in previous.values()} != \
+            {names for _, names in self._last_seen.values()}
+        self._invalidate_cache(stale, names_changed)
+
+        return True
+
+    def invalidate(self, alias=None, owner=None, name=None):
+        """
+        Evicts a service from the cache, so the next get reads it from the
+        database again. This is meant for consumers which learn about
+        changes in the hub before the next update_cache.
+
+        :param alias: Takes precedence when specified over owner/name
+        :param owner: The owner of the service
+        :param name: The name of the service
+        """
+        services = [self._lookup(alias, owner, name)]
+
+        # the service might be cached under its other names as well
+        service = self._get(alias, owner, name)
+        if service is not None:
+            services.append((service.alias, service.username, service.name))
+
+        self._invalidate_cache(services, names_changed=True)
 
+    def _store(self, cache, entries: dict, generation: int):
+        """
+        Stores entries read from the database, unless the cache has been
+        invalidated since the given generation, as they might be outdated.
+        """
         with self.update_lock:
-            self.ttl_cache_for_service_names.clear()
-            self.ttl_cache_for_services.clear()
+            if generation == self._cache_generation:
+                cache.update(entries)
 
-        return True
+    def _invalidate_cache(self, services: list, names_changed: bool):
+        """
+        Evicts the cached lookups of the given services.
+
+        :param services: (alias, owner, name) tuples of the services which
+        were added, modified or removed
+        :param names_changed: When set to true, the cached service names are
+        evicted too
+        """
+        if not services and not names_changed:
+            return
+
+        with self.update_lock:
+            # entries read before this point are not cached anymore
+            self._cache_generation += 1
+
+            if names_changed:
+                self._names_cache.pop(_NAMES_KEY, None)
+
+            for alias, owner, name in services:
+                lookups = []
+                if alias:
+                    lookups.append((alias, None, None))
+
+                if owner and name:
+                    lookups.append((None, owner, name))
+
+                for wrap_service in (False, True):
+                    for lookup in lookups:
+                        key = _service_cache_key(*lookup,
+                                                 wrap_service=wrap_service)
+                        self._svc_cache.pop(key, None)
+                        self._miss_cache.pop(key, None)
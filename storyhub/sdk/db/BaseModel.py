@@ -3,7 +3,13 @@ import os
 
 from peewee import Model, SqliteDatabase
 
-_db = SqliteDatabase(None)
+_db = SqliteDatabase(None, pragmas={
+    # WAL lets readers carry on while update_cache writes
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024
+})
 _initialised = False
 
 
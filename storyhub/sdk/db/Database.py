@@ -7,8 +7,28 @@ class Database:
     def __init__(self, database_path: str):
         first_time = BaseModel.init(db_path=database_path)
         if first_time:
+            Database._drop_unique_owner_name_index()
             BaseModel.create_tables([Service])
 
+    @staticmethod
+    def _drop_unique_owner_name_index():
+        """
+        The (username, name) index used to be unique, which made upserts
+        fail whenever two services swapped their names. It is dropped so
+        create_tables recreates it as a plain index.
+        """
+        db = BaseModel.connect()
+        for index in db.get_indexes('service'):
+            if index.name == 'service_username_name' and index.unique:
+                db.execute_sql('DROP INDEX service_username_name')
+
+    def connect(self):
+        """
+        Opens a connection for the calling thread, unless it holds one
+        already. The connection is kept open until the process exits.
+        """
+        return BaseModel.connect()
+
     def __enter__(self):
         return BaseModel.connect()
 
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import orjson
+
 from peewee import BooleanField, TextField, UUIDField
 
 from storyhub.sdk.db.BaseModel import BaseModel
@@ -12,8 +14,35 @@ class Service(BaseModel):
     description = TextField(null=True)
     certified = BooleanField()
     public = BooleanField()
-    topics = TextField(null=True)
+    _topics_raw = TextField(column_name='topics', null=True)
     state = TextField()
-    configuration = TextField()
+    _configuration_raw = TextField(column_name='configuration')
     readme = TextField(null=True)
     raw_data = TextField(index=False, null=False)
+
+    class Meta:
+        indexes = (
+            # owner/name lookups. Not unique, upserts are applied row by row
+            # and services may swap names within a single update.
+            (('username', 'name'), False),
+        )
+
+    def _parsed(self, attr: str, raw: str):
+        """
+        Parses a JSON column on first access, and memoizes the result for
+        as long as the raw column value stays the same.
+        """
+        parsed = self.__dict__.get(attr)
+        if parsed is None or parsed[0] is not raw:
+            parsed = (raw, None if raw is None else orjson.loads(raw))
+            self.__dict__[attr] = parsed
+
+        return parsed[1]
+
+    @property
+    def topics(self):
+        return self._parsed('_topics', self._topics_raw)
+
+    @property
+    def configuration(self):
+        return self._parsed('_configuration', self._configuration_raw)
@@ -1,3 +1,5 @@
+import sys
+
 from storyhub.sdk.service.ServiceObject import ServiceObject
 
 
@@ -6,6 +8,9 @@ class Argument(ServiceObject):
     Represents an argument, for an event or other service object.
     """
 
+    # services carry many arguments, slots keep each one small
+    __slots__ = ('_name', '_help_', '_type')
+
     def __init__(self, name, help_, type_, data):
         super().__init__(data=data)
 
@@ -15,17 +20,18 @@ class Argument(ServiceObject):
 
     @classmethod
     def from_dict(cls, data):
-        name = data["name"]
         argument = data["argument"]
 
-        return cls(
-            name=name,
-            help_=argument.get(
-                'help', '.not.available'
-            ),
-            type_=argument['type'],
-            data=data
-        )
+        # arguments are built in bulk whenever services are (re)loaded, so
+        # the slots are filled directly rather than through __init__
+        arg = cls.__new__(cls)
+        arg._data = data
+        arg._name = data["name"]
+        arg._help_ = argument.get('help', '.not.available')
+        # types repeat across all arguments, share a single string
+        arg._type = sys.intern(argument['type'])
+
+        return arg
 
     def name(self):
         return self._name
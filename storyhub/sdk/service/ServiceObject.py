@@ -7,6 +7,8 @@ class ServiceObject:
     service structure.
     """
 
+    __slots__ = ('_data',)
+
     def __init__(self, data):
         self._data = data
 
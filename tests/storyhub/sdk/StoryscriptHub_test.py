@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import tempfile
+from threading import Thread
 from time import sleep
 from uuid import UUID
 
@@ -117,6 +118,8 @@ def test_caching(mocker):
 def test_get_with_name(mocker):
     hub = StoryscriptHub(db_path=tempfile.mkdtemp())
     mocker.patch.object(Service, 'select')
+    Service.select().where().get.return_value = Service(
+        username='microservice', name='redis')
 
     assert hub.get("microservice/redis") is not None
 
@@ -127,11 +130,10 @@ not_python_fixture = JsonFixtureHelper.load_fixture("not_python_fixture")
 
 
 def test_service_wrapper(mocker):
-    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), service_wrapper=True)
-
-
     mocker.patch.object(GraphQL, "get_all", return_value=[not_python_fixture])
 
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), service_wrapper=True)
+
     mocker.patch.object(ServiceData, 'from_dict')
 
     assert hub.get("microservice/not_python") is not None
@@ -153,3 +155,328 @@ def test_get_with_wrap_service(mocker):
     ServiceData.from_dict.assert_called_with(data={
         "service_data": not_python_fixture
     })
+
+
+def test_update_cache_diff(mocker):
+    first = VerifiableService(
+        owner_name='diff_username', name='first_diff', alias='first_diff',
+        topics=['diff'], desc='first_description', certified=False,
+        public=True, uuid='0B6E8C4A-5F3D-4B7A-9C41-1E2D3F4A5B6C',
+        state='BETA', config={}, readme='first_readme')
+    second = VerifiableService(
+        owner_name='diff_username', name='second_diff', alias=None,
+        topics=['diff'], desc='second_description', certified=False,
+        public=True, uuid='5A1B2C3D-4E5F-4061-8293-A4B5C6D7E8F9',
+        state='BETA', config={}, readme='second_readme')
+
+    mocker.patch.object(GraphQL, 'get_all',
+                        return_value=[first.service, second.service])
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    hub.update_cache()
+
+    first.verify(hub.get(alias='first_diff'))
+    assert 'diff_username/second_diff' in hub.get_all_service_names()
+
+    modified = VerifiableService(
+        owner_name='diff_username', name='first_diff', alias='first_diff',
+        topics=['diff'], desc='modified_description', certified=True,
+        public=True, uuid=first.uuid, state='BETA', config={},
+        readme='first_readme')
+    GraphQL.get_all.return_value = [modified.service]
+    hub.update_cache()
+
+    modified.verify(hub.get(alias='first_diff'))
+    assert 'diff_username/second_diff' not in hub.get_all_service_names()
+    assert Service.select().where(
+        Service.service_uuid == UUID(second.uuid)).count() == 0
+
+
+def test_update_cache_keeps_unchanged_entries(mocker):
+    unchanged = VerifiableService(
+        owner_name='keep_username', name='unchanged', alias='unchanged',
+        topics=['keep'], desc='unchanged_description', certified=False,
+        public=True, uuid='9E8D7C6B-5A49-4382-A1B0-C9D8E7F6A5B4',
+        state='BETA', config={}, readme='unchanged_readme')
+    modified = VerifiableService(
+        owner_name='keep_username', name='modified', alias=None,
+        topics=['keep'], desc='modified_description', certified=False,
+        public=True, uuid='1F2E3D4C-5B6A-4798-8A7B-6C5D4E3F2A1B',
+        state='BETA', config={}, readme='modified_readme')
+
+    mocker.patch.object(GraphQL, 'get_all',
+                        return_value=[unchanged.service, modified.service])
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    hub.update_cache()
+
+    cached_unchanged = hub.get(alias='unchanged')
+    cached_modified = hub.get('keep_username/modified')
+    names = hub.get_all_service_names()
+
+    modified.service['readme'] = 'new_readme'
+    hub.update_cache()
+
+    assert hub.get(alias='unchanged') is cached_unchanged
+    assert hub.get_all_service_names() is names
+    assert hub.get('keep_username/modified') is not cached_modified
+    assert hub.get('keep_username/modified').readme == 'new_readme'
+
+
+def test_get_many(mocker):
+    first = VerifiableService(
+        owner_name='many_username', name='first_many', alias='first_many',
+        topics=['many'], desc='first_description', certified=False,
+        public=True, uuid='3C2B1A09-8F7E-4D6C-9B5A-493827160F5E',
+        state='BETA', config={}, readme='first_readme')
+    second = VerifiableService(
+        owner_name='many_username', name='second_many', alias=None,
+        topics=['many'], desc='second_description', certified=False,
+        public=True, uuid='6D5C4B3A-2918-4F7E-8D6C-5B4A39281706',
+        state='BETA', config={}, readme='second_readme')
+
+    mocker.patch.object(GraphQL, 'get_all',
+                        return_value=[first.service, second.service])
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    hub.update_cache()
+
+    mocker.spy(Service, 'select')
+    services = hub.get_many([('first_many', None, None),
+                             (None, 'many_username', 'second_many'),
+                             ('many_username/first_many', None, None)])
+
+    first.verify(services[0])
+    second.verify(services[1])
+    first.verify(services[2])
+    assert Service.select.call_count == 1
+
+    assert hub.get(alias='first_many') is services[0]
+    assert hub.get(owner='many_username', name='second_many') is services[1]
+    assert Service.select.call_count == 1
+
+
+def test_concurrent_misses_update_once(mocker):
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+
+    def slow_get_all():
+        sleep(0.2)
+        return []
+
+    mocker.patch.object(GraphQL, 'get_all', side_effect=slow_get_all)
+
+    threads = [Thread(target=hub.get, kwargs={'alias': f'missing_{i}'})
+               for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert GraphQL.get_all.call_count == 1
+
+
+def test_caches_are_per_hub(mocker):
+    service = VerifiableService(
+        owner_name='own_username', name='own_cache', alias='own_cache',
+        topics=['own'], desc='own_description', certified=False,
+        public=True, uuid='8B7A6958-4736-4251-A0F9-E8D7C6B5A493',
+        state='BETA', config={}, readme='own_readme')
+
+    mocker.patch.object(GraphQL, 'get_all', return_value=[service.service])
+    first = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    second = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    first.update_cache()
+
+    cached = first.get(alias='own_cache')
+    assert second.get(alias='own_cache') is not cached
+
+    second.update_cache()
+    assert first.get(alias='own_cache') is cached
+
+
+def test_invalidate(mocker):
+    service = VerifiableService(
+        owner_name='inv_username', name='invalidated', alias='invalidated',
+        topics=['inv'], desc='inv_description', certified=False,
+        public=True, uuid='2A3B4C5D-6E7F-4809-9A1B-2C3D4E5F6071',
+        state='BETA', config={}, readme='inv_readme')
+
+    mocker.patch.object(GraphQL, 'get_all', return_value=[service.service])
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    hub.update_cache()
+
+    by_alias = hub.get(alias='invalidated')
+    by_name = hub.get(owner='inv_username', name='invalidated')
+    names = hub.get_all_service_names()
+
+    hub.invalidate(alias='invalidated')
+
+    assert hub.get(alias='invalidated') is not by_alias
+    assert hub.get(owner='inv_username', name='invalidated') is not by_name
+    assert hub.get_all_service_names() is not names
+
+
+def test_get_shares_entry_for_owner_name_alias(mocker):
+    service = VerifiableService(
+        owner_name='same_username', name='same_entry', alias=None,
+        topics=['same'], desc='same_description', certified=False,
+        public=True, uuid='4F5E6D7C-8B9A-4A0B-8C1D-2E3F4A5B6C7D',
+        state='BETA', config={}, readme='same_readme')
+
+    mocker.patch.object(GraphQL, 'get_all', return_value=[service.service])
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    hub.update_cache()
+
+    by_alias = hub.get('same_username/same_entry')
+    assert hub.get(owner='same_username', name='same_entry') is by_alias
+    assert len(hub._svc_cache) == 1
+
+
+def test_update_cache_restores_rows_deleted_elsewhere(mocker):
+    service = VerifiableService(
+        owner_name='shared_username', name='shared_db', alias='shared_db',
+        topics=['shared'], desc='shared_description', certified=False,
+        public=True, uuid='7E6F5A4B-3C2D-4E1F-8A09-B8C7D6E5F4A3',
+        state='BETA', config={}, readme='shared_readme')
+
+    mocker.patch.object(GraphQL, 'get_all', return_value=[service.service])
+    first = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    second = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    first.update_cache()
+
+    GraphQL.get_all.return_value = []
+    second.update_cache()
+
+    GraphQL.get_all.return_value = [service.service]
+    first.update_cache()
+
+    service.verify(first.get(alias='shared_db'))
+
+
+def test_get_many_updates_once_for_misses(mocker):
+    mocker.patch.object(GraphQL, 'get_all', return_value=[])
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+
+    keys = [(f'unknown_{i}', None, None) for i in range(10)]
+    assert hub.get_many(keys) == [None] * 10
+    assert GraphQL.get_all.call_count == 1
+
+    assert hub.get_many(keys) == [None] * 10
+    assert GraphQL.get_all.call_count == 1
+
+
+def test_get_does_not_cache_rows_invalidated_while_reading(mocker):
+    service = VerifiableService(
+        owner_name='race_username', name='race', alias='race',
+        topics=['race'], desc='race_description', certified=False,
+        public=True, uuid='0C1D2E3F-4A5B-4C6D-9E7F-8091A2B3C4D5',
+        state='BETA', config={}, readme='old')
+
+    mocker.patch.object(GraphQL, 'get_all', return_value=[service.service])
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    hub.update_cache()
+
+    read = hub._get
+
+    def read_then_update(*args):
+        # an update commits right after this reader got the old row
+        row = read(*args)
+        service.service['readme'] = 'new'
+        hub.update_cache()
+        return row
+
+    mocker.patch.object(hub, '_get', side_effect=read_then_update)
+    assert hub.get(alias='race').readme == 'old'
+
+    hub._get = read
+    assert hub.get(alias='race').readme == 'new'
+
+
+def test_update_cache_services_swap_names(mocker):
+    first = VerifiableService(
+        owner_name='swap_username', name='swap_a', alias=None,
+        topics=['swap'], desc='first_description', certified=False,
+        public=True, uuid='1A2B3C4D-5E6F-4A7B-8C9D-0E1F2A3B4C5D',
+        state='BETA', config={}, readme='first_readme')
+    second = VerifiableService(
+        owner_name='swap_username', name='swap_b', alias=None,
+        topics=['swap'], desc='second_description', certified=False,
+        public=True, uuid='6E7F8A9B-0C1D-4E2F-9A3B-4C5D6E7F8A9B',
+        state='BETA', config={}, readme='second_readme')
+
+    mocker.patch.object(GraphQL, 'get_all',
+                        return_value=[first.service, second.service])
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    hub.update_cache()
+
+    first.service['service']['name'] = 'swap_b'
+    second.service['service']['name'] = 'swap_a'
+    hub.update_cache()
+
+    assert hub.get('swap_username/swap_a').readme == 'second_readme'
+    assert hub.get('swap_username/swap_b').readme == 'first_readme'
+
+
+def test_update_cache_evicts_when_another_hub_wrote_first(mocker):
+    service = VerifiableService(
+        owner_name='first_username', name='written_first',
+        alias='written_first', topics=['first'], desc='first_description',
+        certified=False, public=True,
+        uuid='5B6C7D8E-9F0A-4B1C-8D2E-3F4A5B6C7D8E', state='BETA',
+        config={}, readme='old')
+
+    mocker.patch.object(GraphQL, 'get_all', return_value=[service.service])
+    first = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    second = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+    first.update_cache()
+    second.update_cache()
+    assert first.get(alias='written_first').readme == 'old'
+
+    service.service['readme'] = 'new'
+    second.update_cache()
+    first.update_cache()
+
+    assert first.get(alias='written_first').readme == 'new'
+    assert second.get(alias='written_first').readme == 'new'
+
+
+def test_get_misses_expire(mocker):
+    mocker.patch.object(GraphQL, 'get_all', return_value=[])
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+
+    assert hub.get('missing_username/published_later') is None
+    assert hub.get('missing_username/published_later') is None
+    assert GraphQL.get_all.call_count == 1
+
+    # the miss expired
+    hub._miss_cache.clear()
+
+    published = VerifiableService(
+        owner_name='missing_username', name='published_later', alias=None,
+        topics=['later'], desc='later_description', certified=False,
+        public=True, uuid='9A8B7C6D-5E4F-4A3B-9C2D-1E0F9A8B7C6D',
+        state='BETA', config={}, readme='later_readme')
+    GraphQL.get_all.return_value = [published.service]
+
+    published.verify(hub.get('missing_username/published_later'))
+    assert GraphQL.get_all.call_count == 2
+
+
+def test_get_many_misses_expire(mocker):
+    mocker.patch.object(GraphQL, 'get_all', return_value=[])
+    hub = StoryscriptHub(db_path=tempfile.mkdtemp(), auto_update=False)
+
+    keys = [('many_published_later', None, None)]
+    assert hub.get_many(keys) == [None]
+    assert GraphQL.get_all.call_count == 1
+
+    # the miss expired
+    hub._miss_cache.clear()
+
+    published = VerifiableService(
+        owner_name='many_missing_username', name='many_published_later',
+        alias='many_published_later', topics=['later'],
+        desc='later_description', certified=False, public=True,
+        uuid='3D4E5F6A-7B8C-4D9E-8F0A-1B2C3D4E5F6A', state='BETA',
+        config={}, readme='later_readme')
+    GraphQL.get_all.return_value = [published.service]
+
+    published.verify(hub.get_many(keys)[0])
+    assert GraphQL.get_all.call_count == 2
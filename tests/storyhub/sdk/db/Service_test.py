@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import orjson
+
+from storyhub.sdk.db.Service import Service
+
+
+def test_json_columns_parsed_lazily(mocker):
+    service = Service(_topics_raw='["a", "b"]',
+                      _configuration_raw='{"a": 1}')
+
+    mocker.spy(orjson, 'loads')
+
+    assert service.topics == ['a', 'b']
+    assert service.topics is service.topics
+    orjson.loads.assert_called_once_with('["a", "b"]')
+
+    assert service.configuration == {'a': 1}
+    assert orjson.loads.call_count == 2
+
+
+def test_json_columns_follow_raw_value():
+    service = Service(_topics_raw=None, _configuration_raw='{}')
+
+    assert service.topics is None
+
+    service._topics_raw = '["c"]'
+    assert service.topics == ['c']
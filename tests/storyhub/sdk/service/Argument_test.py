@@ -29,3 +29,23 @@ def test_serialization(mocker):
     assert service_command.as_json() is not None
     json.dumps.assert_called_with(argument_fixture, indent=4, sort_keys=True)
 
+
+def test_slots():
+    argument = Argument.from_dict(data=argument_fixture)
+
+    assert not hasattr(argument, '__dict__')
+    assert argument.raw_data() == argument_fixture
+
+
+def test_from_dict_matches_init():
+    argument = Argument.from_dict(data=argument_fixture)
+    expected = Argument(name=argument_fixture['name'],
+                        help_=argument_fixture['argument'].get(
+                            'help', '.not.available'),
+                        type_=argument_fixture['argument']['type'],
+                        data=argument_fixture)
+
+    assert argument.name() == expected.name()
+    assert argument.help() == expected.help()
+    assert argument.type() == expected.type()
+    assert argument.raw_data() == expected.raw_data()